@@ -4,15 +4,25 @@
 # Released under the same license terms as gPodder itself.
 
 # Use a logger for debug output - this will be managed by gPodder
+import io
 import logging
+import mmap
 import os
 import shutil
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from filelock import SoftFileLock
-from PIL import Image
+from PIL import Image, features
+
+try:
+    # optional: streaming resize+encode without materializing the full bitmap
+    import pyvips
+except ImportError:
+    pyvips = None
 
 import gpodder
-from gpodder import coverart
+from gpodder import coverart, util
 
 import gi  # isort:skip
 gi.require_version("Gtk", "3.0")
@@ -37,12 +47,310 @@ DefaultConfig = {
 }
 
 
+def _probe_image(path):
+    """Read image format, dimensions and progressive flag from file headers.
+
+    Scans the PNG IHDR chunk or walks the JPEG marker segments, so no
+    pixel data is ever decoded. Returns a tuple
+    (format, width, height, progressive), or None if the headers cannot
+    be parsed (caller should fall back to PIL).
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(24)
+            if head[:8] == b"\x89PNG\r\n\x1a\n":
+                if head[12:16] != b"IHDR":
+                    return None
+                width, height = struct.unpack(">II", head[16:24])
+                return ("PNG", width, height, False)
+            if head[:2] == b"\xff\xd8":
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        return None
+                    code = marker[1]
+                    if code == 0xFF:
+                        # fill byte, resync on the next byte
+                        f.seek(-1, 1)
+                        continue
+                    if code == 0x01 or 0xD0 <= code <= 0xD9:
+                        # standalone marker without a length field
+                        continue
+                    data = f.read(2)
+                    if len(data) < 2:
+                        return None
+                    (seglen,) = struct.unpack(">H", data)
+                    if seglen < 2:
+                        return None
+                    if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+                        sof = f.read(5)
+                        if len(sof) < 5:
+                            return None
+                        height, width = struct.unpack(">xHH", sof)
+                        progressive = code in (0xC2, 0xC6, 0xCA, 0xCE)
+                        return ("JPEG", width, height, progressive)
+                    if code == 0xDA:
+                        # start of scan without a preceding SOF
+                        return None
+                    f.seek(seglen - 2, 1)
+    except OSError:
+        pass
+    return None
+
+
+def _fast_match(probe, target, desired_format):
+    """Check if a probed source image can be copied to the device as-is.
+
+    True when the headers show the desired format, baseline encoding and
+    no dimension above target - in that case a plain file copy replaces
+    the whole decode+encode cycle.
+    """
+    if probe is None:
+        return False
+    art_format, width, height, progressive = probe
+    return (art_format == desired_format and not progressive
+            and max(width, height) <= target)
+
+
 class gPodderExtension:
 
     def __init__(self, container):
         self.container = container
         self.config = self.container.config
 
+        # encoded cover art, keyed by source file and conversion settings,
+        # so the episodes of one channel share a single resize+encode
+        self._cover_cache = {}
+
+        # conversions run off the sync worker so the next episode's copy
+        # is not stalled behind image processing
+        workers = min(4, os.cpu_count() or 1)
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._futures = []
+
+        # backpressure: let a couple of covers queue up behind the running
+        # workers, then make the sync loop wait instead of piling up tasks
+        self._queue_slots = threading.BoundedSemaphore(workers + 2)
+
+        # serializes writes to the device between pool workers; much
+        # cheaper than a SoftFileLock sidecar file per episode
+        self._write_lock = threading.Lock()
+
+        # jpegtran (if installed) converts progressive JPEG to baseline as a
+        # lossless DCT-coefficient rewrite, much cheaper than transcoding
+        self._jpegtran = util.find_command('jpegtran')
+
+        # names derived from art_name_on_device; recomputed when it changes
+        self._recompute_derived()
+
+        try:
+            if not features.check_feature('libjpeg_turbo'):
+                logger.warning('Pillow is not built against libjpeg-turbo, '
+                        'JPEG conversion of cover art will be slower')
+        except ValueError:
+            # Pillow too old to know about the feature flag
+            pass
+
+    def _recompute_derived(self):
+        # discover desired filetype; a name without extension falls back to jpg
+        device_filename, ext = os.path.splitext(self.config.art_name_on_device)
+        device_filetype = ext.lstrip(".") or "jpg"
+
+        # only allow jpeg, jpg, and png - if invalid, default to jpg
+        if device_filetype.lower() not in ("jpeg", "jpg", "png"):
+            device_filetype = "jpg"
+
+        # sanitize for filetype checking - "jpg" will not match "jpeg"
+        if device_filetype.upper() == "JPG":
+            device_match_filetype = "JPEG"
+        else:
+            device_match_filetype = device_filetype.upper()
+
+        self._derived = (device_filename, device_filetype, device_match_filetype)
+
+    def _vips_convert(self, episode_art, device_match_filetype, target, upscale):
+        """Resize and encode with pyvips, returning the encoded bytes.
+
+        pyvips runs decode (with JPEG shrink-on-load), resize and encode
+        as one demand-driven pipeline, so the full-size bitmap is never
+        materialized in memory. Returns None on failure so the caller
+        can fall back to PIL.
+        """
+        try:
+            thumb = pyvips.Image.thumbnail(episode_art, target, height=target,
+                    size='both' if upscale else 'down')
+            if device_match_filetype == "JPEG":
+                return thumb.write_to_buffer(".jpg", Q=90, interlace=False, strip=True)
+            return thumb.write_to_buffer(".png", compression=1)
+        except pyvips.Error as e:
+            logger.info("%s pyvips conversion error: %r", episode_art, e)
+            return None
+
+    def _needs_copy(self, device_art, device_match_filetype, target, upscale):
+        """Probe stage: decide whether the device file must be (re)written.
+
+        Only header reads happen here, so the caller can hold the write
+        lock briefly and run the expensive conversion outside of it.
+        """
+        try:
+            os.stat(device_art)
+        except OSError:
+            # file does not exist, we will create it
+            return True
+
+        # file exists, check if it's what we want or not
+        probe = _probe_image(device_art)
+        if probe is not None:
+            art_format, art_width, art_height, art_progressive = probe
+            imgsize = max(art_height, art_width)
+            if imgsize != target and upscale:
+                return True
+            elif imgsize > target and not upscale:
+                return True
+            elif art_format != device_match_filetype:
+                return True
+            elif art_progressive:
+                return True
+            return False
+
+        # header scan failed, fall back to a full PIL open
+        try:
+            with Image.open(device_art) as img:
+                imgsize = max(img.height, img.width)
+                if imgsize != target and upscale:
+                    return True
+                elif imgsize > target and not upscale:
+                    return True
+                elif img.format.upper() != device_match_filetype:
+                    return True
+                # key is absent for baseline jpeg and png
+                if img.info.get('progressive') == 1:
+                    return True
+        except OSError as e:
+            logger.info("%s check image error: %r", device_art, e)
+        return False
+
+    def _process_cover(self, episode_art, device_art, device_match_filetype):
+        # runs on the worker pool - PIL and libjpeg release the GIL around
+        # the actual decode, resize and encode work
+        try:
+            src_st = os.stat(episode_art)
+        except OSError:
+            # no source art to copy
+            return
+
+        target = int(self.config.convert_size)
+        upscale = bool(self.config.convert_allow_upscale_art)
+
+        # probe stage: cheap header reads under the lock, so the decision
+        # is not made while another worker writes the same file
+        with self._write_lock:
+            copyflag = self._needs_copy(device_art, device_match_filetype,
+                    target, upscale)
+
+        if not copyflag:
+            logger.info("%s already exists", device_art)
+            return
+
+        logger.info("%s copying", device_art)
+
+        src_probe = _probe_image(episode_art)
+
+        # source already correctly sized, baseline and in the right
+        # format: plain file copy, no image codec involved
+        if not upscale and _fast_match(src_probe, target, device_match_filetype):
+            try:
+                with self._write_lock:
+                    shutil.copyfile(episode_art, device_art)
+            except OSError as e:
+                logger.info("%s fast copy error: %r", episode_art, e)
+            return
+
+        # correctly sized JPEG that is merely progressive: rewrite
+        # it losslessly with jpegtran instead of transcoding
+        if (self._jpegtran and src_probe is not None
+                and device_match_filetype == "JPEG"
+                and not upscale):
+            art_format, art_width, art_height, art_progressive = src_probe
+            if (art_format == "JPEG" and art_progressive
+                    and max(art_width, art_height) <= target):
+                try:
+                    with self._write_lock:
+                        returncode = util.Popen([self._jpegtran, '-copy', 'none',
+                                '-optimize', '-outfile', device_art, episode_art],
+                                close_fds=True).wait()
+                except OSError as e:
+                    logger.info("%s jpegtran error: %r", episode_art, e)
+                else:
+                    if returncode == 0:
+                        return
+                    logger.info("%s jpegtran exited with %d, falling back",
+                            episode_art, returncode)
+
+        # convert stage: decode+resize+encode runs without the lock, so it
+        # overlaps with other workers' device writes
+        cache_key = (episode_art, src_st.st_mtime,
+                target, device_match_filetype,
+                upscale)
+        data = self._cover_cache.get(cache_key)
+        if data is None and pyvips is not None:
+            data = self._vips_convert(episode_art, device_match_filetype, target, upscale)
+        if data is None:
+            try:
+                # should we file lock the source file?
+                # decode from a memory map: libjpeg reads straight from
+                # kernel-cached pages instead of many small read() calls
+                with open(episode_art, "rb") as src_file, \
+                        mmap.mmap(src_file.fileno(), 0,
+                            access=mmap.ACCESS_READ) as mm, \
+                        Image.open(mm) as img:
+                    if img.height > target or img.width > target:
+                        if img.format == "JPEG":
+                            # let libjpeg scale in the DCT domain while
+                            # decoding, skipping most of the IDCT work
+                            img.draft("RGB", (target * 2, target * 2))
+                        # explicit filter so the SIMD-accelerated convolution
+                        # path is taken (and output is stable across PIL
+                        # versions); for a pure decimation BOX is visually
+                        # equivalent to the heavier filters and much cheaper
+                        ratio = max(img.height, img.width) / target
+                        if ratio >= 2 and ratio == int(ratio):
+                            resample = Image.Resampling.BOX
+                        else:
+                            resample = Image.Resampling.BILINEAR
+                        img.thumbnail((target, target), resample)
+                        out = img
+                    elif upscale:
+                        ratio = min(target / img.height, target / img.width)
+                        newsize = (int(ratio * img.width), int(ratio * img.height))
+                        out = img.resize(newsize, resample=Image.Resampling.LANCZOS)
+                    else:
+                        # no resize needed, encode straight from img
+                        out = img
+                    buffer = io.BytesIO()
+                    if device_match_filetype == "JPEG":
+                        # baseline in a single pass; optimize=True would
+                        # force a slow two-pass encode
+                        out.save(buffer, format="JPEG",
+                                progressive=False, optimize=False, quality=90)
+                    else:
+                        out.save(buffer, format="PNG", compress_level=1)
+                    data = buffer.getvalue()
+            except (OSError, ValueError) as e:
+                # ValueError: mmap of an empty file
+                logger.info("%s copy image error: %r", episode_art, e)
+
+        # write stage: only the device write itself is serialized
+        if data is not None:
+            self._cover_cache[cache_key] = data
+            try:
+                with self._write_lock:
+                    with open(device_art, "wb") as f:
+                        f.write(data)
+            except OSError as e:
+                logger.info("%s write image error: %r", device_art, e)
+
     def on_episode_synced(self, device, episode):
         # check that we have the functions we need
         if hasattr(device, 'get_episode_folder_on_device'):
@@ -50,18 +358,8 @@ class gPodderExtension:
             episode_folder = os.path.dirname(episode.local_filename(False))
             device_folder = device.get_episode_folder_on_device(episode)
 
-            # discover desired filetype
-            device_filename, device_filetype = self.config.art_name_on_device.rsplit(".", 1)
-
-            # only allow jpeg, jpg, and png - if invalid, default to jpg
-            if device_filetype.lower() not in ("jpeg", "jpg", "png"):
-                device_filetype = "jpg"
-
-            # sanitize for filetype checking - "jpg" will not match "jpeg"
-            if device_filetype.upper() == "JPG":
-                device_match_filetype = "JPEG"
-            else:
-                device_match_filetype = device_filetype.upper()
+            # desired filename/filetype, precomputed from the config
+            device_filename, device_filetype, device_match_filetype = self._derived
 
             if self.config.convert_and_resize_art:
                 # episode.channel.cover_file gives us the file and path (no extension!),
@@ -72,66 +370,11 @@ class gPodderExtension:
 
                 device_art = os.path.join(device_folder, "%s.%s" %
                     (device_filename, device_filetype))
-                device_lockpath = "%s.lock" % device_art
-                device_lockfile = SoftFileLock(device_lockpath, blocking=False)
-
-                if os.path.isfile(episode_art):
-                    copyflag = False
-
-                    # if already exists, check if it's what we want:
-                    try:
-                        # lock the file first, otherwise we can easily crash
-                        # N.B. Be careful when modifying anything within this try: except
-                        # block - All branches should catch their own exceptions so that
-                        # we always release the lockfile!
-                        device_lockfile.acquire()
-                    except:
-                        logger.info('Could not acquire file lock for %s', device_art)
-                    else:
-                        # file exists, check if it's what we want or not
-                        if os.path.isfile(device_art):
-                            try:
-                                with Image.open(device_art) as img:
-                                    imgsize = max(img.height, img.width)
-                                    if imgsize != int(self.config.convert_size) and\
-                                            self.config.convert_allow_upscale_art:
-                                        copyflag = True
-                                    elif imgsize > int(self.config.convert_size) and\
-                                            not self.config.convert_allow_upscale_art:
-                                        copyflag = True
-                                    elif img.format.upper() != device_match_filetype:
-                                        copyflag = True
-                                    try:
-                                        if img.info['progressive'] == 1:
-                                            copyflag = True
-                                    except:
-                                        pass  # expected result if baseline jpeg or png
-                            except OSError as e:
-                                copyflag = False
-                                logger.info("%s check image error: %r", device_art, e)
-                        # file does not exist, we will create it
-                        else:
-                            copyflag = True
-
-                        if copyflag:
-                            logger.info("%s %s" % (device_art, "copying"))
-                            try:
-                                # should we file lock the source file?
-                                with Image.open(episode_art) as img:
-                                    if img.height > int(self.config.convert_size)\
-                                            or self.config.convert_allow_upscale_art:
-                                        ratio = min(self.config.convert_size / img.height, self.config.convert_size / img.width)
-                                        newsize = (int(ratio * img.width), int(ratio * img.height))
-                                        out = img.resize(newsize)
-                                    else:
-                                        out = img.copy()
-                                    out.save(device_art)
-                            except OSError as e:
-                                logger.info("%s copy image error: %r", episode_art, e)
-                        else:
-                            logger.info("%s already exists" % device_art)
-
-                        device_lockfile.release()
+                self._queue_slots.acquire()
+                future = self._pool.submit(
+                        self._process_cover, episode_art, device_art, device_match_filetype)
+                future.add_done_callback(lambda _future: self._queue_slots.release())
+                self._futures.append(future)
 
             # original functionality
             else:
@@ -144,6 +387,16 @@ class gPodderExtension:
                     # copy and rename art
                     shutil.copy(episode_art, device_art)
 
+    def on_all_episodes_synced(self):
+        # wait for pending conversions so the device is safe to unmount
+        futures, self._futures = self._futures, []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as exception:
+                logger.error('Cover art conversion failed: %s', exception,
+                        exc_info=True)
+
     def toggle_sensitivity_of_widgets(self):
         # all options rely on convert_and_resize_art being true
         self.container.convert_allow_upscale.set_sensitive(self.config.convert_and_resize_art)
@@ -165,8 +418,17 @@ class gPodderExtension:
 
     def on_art_name_on_device_changed(self, widget):
         self.config.art_name_on_device = widget.get_text()
+        self._recompute_derived()
+
+    def on_box_destroy(self, widget):
+        # the dialog takes the widget tree down with it, rebuild next time
+        self.container.preferences_box = None
 
     def show_preferences(self):
+        # build the ~15 widgets only once per dialog lifetime
+        if getattr(self.container, 'preferences_box', None) is not None:
+            return self.container.preferences_box
+
         box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
         box.set_border_width(10)
 
@@ -240,7 +502,9 @@ class gPodderExtension:
 
         self.toggle_sensitivity_of_widgets()
 
+        box.connect('destroy', self.on_box_destroy)
         box.show_all()
+        self.container.preferences_box = box
         return box
 
     def on_preferences(self):
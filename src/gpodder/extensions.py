@@ -29,11 +29,12 @@ For an example extension see share/gpodder/examples/extensions.py
 """
 
 import functools
-import glob
 import importlib
 import logging
 import os
 import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import gpodder
 from gpodder import util
@@ -51,26 +52,86 @@ CATEGORY_DICT = {
 }
 DEFAULT_CATEGORY = _('Other')
 
+# compiled once instead of per scanned extension file; the optional
+# second group marks values wrapped in _('...') for localization
+_METADATA_RE = re.compile(r"__([a-z_]+)__ = (_\()?'([^']+)'\)?")
 
-def call_extensions(func):
-    """Decorate a function to create handler in ExtensionManager.
 
-    Calls the specified function in all user extensions that define it.
+def _split_order_prefix(name):
+    """Split a "<digits>_rest" ordering prefix off an extension name.
+
+    Returns (priority, name). Names without a prefix keep the default
+    priority 99; a bare leading underscore is stripped without changing
+    the priority.
+    """
+    i = 0
+    while i < len(name) and name[i].isdigit():
+        i += 1
+    if i < len(name) and name[i] == '_' and len(name) > i + 1:
+        return (int(name[:i]) if i else 99, name[i + 1:])
+    return (99, name)
+
+
+_ACTIVE_UIS = None
+
+
+def _active_uis():
+    """Names of the UIs currently active in gpodder.ui, as a frozenset.
+
+    Computed lazily because the UI flags are only set during startup,
+    after this module has been imported.
     """
+    global _ACTIVE_UIS
+    if _ACTIVE_UIS is None:
+        _ACTIVE_UIS = frozenset(name for name, value in vars(gpodder.ui).items()
+                if not name.startswith('_') and value)
+    return _ACTIVE_UIS
+
+
+def _extension_handler(func, accumulate_list):
+    """Build the dispatching handler shared by the decorators below."""
     method_name = func.__name__
 
     @functools.wraps(func)
     def handler(self, *args, **kwargs):
-        result = None
-        for container in self.containers:
-            if not container.enabled or container.module is None:
-                continue
-
-            try:
-                callback = getattr(container.module, method_name, None)
-                if callback is None:
+        if not self.containers:
+            # no extensions installed (or extensions disabled entirely)
+            func(self, *args, **kwargs)
+            return None
+
+        callbacks = self._callback_cache.get(method_name)
+        if callbacks is None:
+            # bound callbacks per hook, rebuilt whenever an extension is
+            # enabled or disabled (set_enabled clears the cache)
+            callbacks = []
+            for container in self.containers:
+                if not container.enabled or container.module is None:
                     continue
+                callback = getattr(container.module, method_name, None)
+                if callback is not None:
+                    callbacks.append((container, callback))
+            self._callback_cache[method_name] = callbacks
+
+        if not callbacks:
+            # nothing implements this hook, skip the dispatch loop
+            func(self, *args, **kwargs)
+            return None
+
+        if not accumulate_list:
+            # high-frequency hooks don't return anything useful, so skip
+            # the result merging entirely
+            for container, callback in callbacks:
+                try:
+                    callback(*args, **kwargs)
+                except Exception as exception:
+                    logger.error('Error in %s in %s: %s', container.filename,
+                            method_name, exception, exc_info=True)
+            func(self, *args, **kwargs)
+            return None
 
+        result = None
+        for container, callback in callbacks:
+            try:
                 # If the results are lists, concatenate them to show all
                 # possible items that are generated by all extension together
                 cb_res = callback(*args, **kwargs)
@@ -87,21 +148,32 @@ def call_extensions(func):
     return handler
 
 
+def call_extensions(func):
+    """Decorate a function to create handler in ExtensionManager.
+
+    Calls the specified function in all user extensions that define it;
+    callback return values are discarded.
+    """
+    return _extension_handler(func, False)
+
+
+def call_extensions_list(func):
+    """Decorate a hook whose callbacks produce menu/preference entries.
+
+    Like call_extensions(), but list results from the individual
+    extensions are concatenated and returned to the caller.
+    """
+    return _extension_handler(func, True)
+
+
 class ExtensionMetadata(object):
     # Default fallback metadata in case metadata fields are missing
     DEFAULTS = {
         'description': _('No description for this extension.'),
         'doc': None,
     }
-    SORTKEYS = {
-        'title': 1,
-        'description': 2,
-        'category': 3,
-        'authors': 4,
-        'only_for': 5,
-        'mandatory_in': 6,
-        'disable_in': 7,
-    }
+    SORTKEYS = ('title', 'description', 'category', 'authors',
+            'only_for', 'mandatory_in', 'disable_in')
 
     def __init__(self, container, metadata):
         if 'title' not in metadata:
@@ -111,6 +183,13 @@ class ExtensionMetadata(object):
         metadata['category'] = CATEGORY_DICT.get(category, DEFAULT_CATEGORY)
 
         self.__dict__.update(metadata)
+        # lowercased UI tokens per field, parsed once for check_ui()
+        self._ui_tokens = {
+            key: tuple(x.strip().lower()
+                for x in metadata[key].split(',') if x.strip())
+            for key in ('only_for', 'mandatory_in', 'disable_in')
+            if key in metadata}
+        self._ui_cache = {}
 
     def __getattr__(self, name):
         try:
@@ -119,11 +198,13 @@ class ExtensionMetadata(object):
             raise AttributeError(name, e)
 
     def get_sorted(self):
-
-        def kf(x):
-            return self.SORTKEYS.get(x[0], 99)
-
-        return sorted([(k, v) for k, v in list(self.__dict__.items())], key=kf)
+        # well-known keys first (in SORTKEYS order), then everything else
+        # in insertion order - no need to sort the whole dict
+        items = self.__dict__
+        result = [(k, items[k]) for k in self.SORTKEYS if k in items]
+        result.extend((k, v) for k, v in items.items()
+            if k not in self.SORTKEYS and not k.startswith('_'))
+        return result
 
     def check_ui(self, target, default):
         """Check metadata information.
@@ -153,11 +234,15 @@ class ExtensionMetadata(object):
 
         New, unknown UIs are silently ignored and will evaluate to False.
         """
-        if not hasattr(self, target):
-            return default
-
-        uis = [_f for _f in [x.strip() for x in getattr(self, target).split(',')] if _f]
-        return any(getattr(gpodder.ui, ui.lower(), False) for ui in uis)
+        result = self._ui_cache.get(target)
+        if result is None:
+            uis = self._ui_tokens.get(target)
+            if uis is None:
+                result = default
+            else:
+                result = not _active_uis().isdisjoint(uis)
+            self._ui_cache[target] = result
+        return result
 
     @property
     def available_for_current_ui(self):
@@ -188,7 +273,12 @@ class MissingCommand(MissingDependency):
 
 
 class ExtensionContainer(object):
-    """An extension container wraps one extension module."""
+    """An extension container wraps one extension module.
+
+    Extensions are free to store ad-hoc attributes on their container
+    (e.g. preference widgets), so this class must keep its instance
+    dict - do not add __slots__.
+    """
 
     def __init__(self, manager, name, config, filename=None, priority=99, module=None):
         self.manager = manager
@@ -203,7 +293,15 @@ class ExtensionContainer(object):
 
         self.default_config = None
         self.parameters = None
-        self.metadata = ExtensionMetadata(self, self._load_metadata(filename))
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        """Metadata header of the extension file, parsed on first access."""
+        if self._metadata is None:
+            self._metadata = ExtensionMetadata(self,
+                    self._load_metadata(self.filename))
+        return self._metadata
 
     def require_command(self, command):
         """Check if the given command is installed on the system.
@@ -238,17 +336,16 @@ class ExtensionContainer(object):
         if not filename or not os.path.exists(filename):
             return {}
 
-        encoding = util.guess_encoding(filename)
-        with open(filename, "r", encoding=encoding) as f:
-            extension_py = f.read()
-        metadata = dict(re.findall(r"__([a-z_]+)__ = '([^']+)'", extension_py))
-
-        # Support for using gpodder.gettext() as _ to localize text
-        localized_metadata = dict(re.findall(r"__([a-z_]+)__ = _\('([^']+)'\)",
-            extension_py))
-
-        for key in localized_metadata:
-            metadata[key] = gpodder.gettext(localized_metadata[key])
+        # the metadata dunders live at the top of the file by convention,
+        # no need to read (and scan) the whole source; decoding the header
+        # as UTF-8 also avoids a separate guess_encoding() pass per file
+        with open(filename, "rb") as f:
+            extension_py = f.read(4096).decode('utf-8', errors='replace')
+        metadata = {}
+        for m in _METADATA_RE.finditer(extension_py):
+            key, localized, value = m.group(1, 2, 3)
+            # Support for using gpodder.gettext() as _ to localize text
+            metadata[key] = gpodder.gettext(value) if localized else value
 
         return metadata
 
@@ -282,6 +379,7 @@ class ExtensionContainer(object):
                 logger.error('Failed to on_unload %s: %s', self.name,
                         exception, exc_info=True)
             self.enabled = False
+        self.manager._callback_cache.clear()
 
     def load_extension(self):
         """Load and initialize the gPodder extension module."""
@@ -295,15 +393,19 @@ class ExtensionContainer(object):
             return
 
         basename, _ = os.path.splitext(os.path.basename(self.filename))
-        try:
-            # from load_source() on https://docs.python.org/dev/whatsnew/3.12.html
+        # re-enabling an extension reuses the module executed earlier in
+        # this session instead of compiling and running it again
+        module_key = 'gpodder_ext_%s' % basename
+        module_file = sys.modules.get(module_key)
+        if module_file is None:
+            # from load_source() on https://docs.python.org/dev/whatsnew/3.12.html;
+            # bytecode goes to sys.pycache_prefix (set by ExtensionManager),
+            # so later sessions skip recompiling unchanged extensions
             loader = importlib.machinery.SourceFileLoader(basename, self.filename)
             spec = importlib.util.spec_from_file_location(basename, self.filename, loader=loader)
             module_file = importlib.util.module_from_spec(spec)
             loader.exec_module(module_file)
-        finally:
-            # Remove the .pyc file if it was created during import
-            util.delete_file(self.filename + 'c')
+            sys.modules[module_key] = module_file
 
         self.default_config = getattr(module_file, 'DefaultConfig', {})
         if self.default_config:
@@ -312,7 +414,10 @@ class ExtensionContainer(object):
                     self.name: self.default_config,
                 }
             })
-        self.config = getattr(self.manager.core.config.extensions, self.name)
+            # registering defaults rebuilds the config tree, so the proxy
+            # has to be fetched afterwards; without defaults the one from
+            # __init__ is still valid
+            self.config = getattr(self.manager.core.config.extensions, self.name)
 
         self.module = module_file.gPodderExtension(self)
         logger.info('Module loaded: %s', self.filename)
@@ -325,9 +430,17 @@ class ExtensionManager(object):
         self.core = core
         self.filenames = os.environ.get('GPODDER_EXTENSIONS', '').split()
         self.containers = []
+        # per-hook lists of (container, bound callback); cleared whenever
+        # a container's enabled state changes
+        self._callback_cache = {}
+
+        # cache extension bytecode in a user-owned location instead of
+        # writing .pyc files next to the (possibly read-only) sources
+        if sys.pycache_prefix is None:
+            sys.pycache_prefix = os.path.join(gpodder.home, '__pycache__')
 
         core.config.add_observer(self._config_value_changed)
-        enabled_extensions = core.config.extensions.enabled
+        enabled_extensions = frozenset(core.config.extensions.enabled)
 
         self.builtins_directory = os.path.join(gpodder.prefix, 'share', 'gpodder',
                 'extensions')
@@ -337,14 +450,24 @@ class ExtensionManager(object):
             logger.info('Disabling all extensions (from environment)')
             return
 
+        containers = []
         for name, (extension_priority, filename) in self._find_extensions():
             logger.debug('Found extension "%s", priority %s, in %s', name, extension_priority, filename)
             config = getattr(core.config.extensions, name)
-            container = ExtensionContainer(self, name, config, filename, priority=extension_priority)
-            if (name in enabled_extensions
+            containers.append(ExtensionContainer(self, name, config, filename,
+                    priority=extension_priority))
+
+        # metadata is loaded lazily, but the mandatory_in_current_ui check
+        # below needs every header anyway; the reads are small and dominated
+        # by open()/read() latency, so warm the caches concurrently
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda container: container.metadata, containers))
+
+        for container in containers:
+            if (container.name in enabled_extensions
                     or container.metadata.mandatory_in_current_ui):
                 container.set_enabled(True)
-            if (name in enabled_extensions
+            if (container.name in enabled_extensions
                     and container.metadata.disable_in_current_ui):
                 container.set_enabled(False)
             self.containers.append(container)
@@ -357,6 +480,7 @@ class ExtensionManager(object):
         if name != 'extensions.enabled':
             return
 
+        new_value = set(new_value)
         for container in self.containers:
             new_enabled = (container.name in new_value)
             if new_enabled == container.enabled:
@@ -378,33 +502,40 @@ class ExtensionManager(object):
     def _find_extensions(self):
         extensions = {}
 
-        if not self.filenames:
-            builtins = os.path.join(self.builtins_directory, '*.py')
-            user_extensions = os.path.join(self.user_extension_directory, '*.py')
+        if self.filenames:
+            # explicit list from $GPODDER_EXTENSIONS, may point anywhere
+            filenames = []
+            for filename in self.filenames:
+                if not filename or not os.path.exists(filename):
+                    logger.info('Skipping non-existing file: %s', filename)
+                    continue
+                filenames.append(filename)
+        else:
+            def _scan(dirpath):
+                # DirEntry caches the file type, so this is one stat per
+                # entry instead of the glob+exists double-check
+                try:
+                    with os.scandir(dirpath) as entries:
+                        return [entry.path for entry in entries
+                                if entry.name.endswith('.py') and entry.is_file()]
+                except FileNotFoundError:
+                    return []
+
             # sort filenames so that if duplicates are found in the same folder,
             # the highest priority (lowest number) will always be used.
-            self.filenames = sorted(glob.glob(builtins), reverse=True) \
-                + sorted(glob.glob(user_extensions), reverse=True)
+            filenames = sorted(_scan(self.builtins_directory), reverse=True) \
+                + sorted(_scan(self.user_extension_directory), reverse=True)
+            self.filenames = filenames
 
         # Let user extensions override built-in extensions of the same name.
         # This inherently happens because we search the user extensions folder second,
         # and the entries are put in the extensions dict by their name field.
-        for filename in self.filenames:
-            if not filename or not os.path.exists(filename):
-                logger.info('Skipping non-existing file: %s', filename)
-                continue
-
+        for filename in filenames:
             name, _ = os.path.splitext(os.path.basename(filename))
 
+            # get ordering prefix and strip it from the name (or leading _);
             # extensions with no priority get priority 99
-            priority = 99
-            m = re.fullmatch(r'^([0-9]*)_(.+)', name)
-            if m:
-                if m.group(1):
-                    # get ordering prefix
-                    priority = int(m.group(1))
-                # strip ordering prefix from name (or leading _)
-                name = m.group(2)
+            priority, name = _split_order_prefix(name)
             _, previous_filename = extensions.get(name, (None, None))
             if previous_filename is not None:
                 if os.path.dirname(filename) == os.path.dirname(previous_filename):
@@ -536,7 +667,7 @@ class ExtensionManager(object):
     def on_all_episodes_synced(self):
         """Called when all episodes have been synchronized."""  # noqa: D401
 
-    @call_extensions
+    @call_extensions_list
     def on_create_menu(self):
         """Called when the Extras menu is created.
 
@@ -549,7 +680,7 @@ class ExtensionManager(object):
         [('Sync to Smartphone', lambda : ...)]
         """  # noqa: D401
 
-    @call_extensions
+    @call_extensions_list
     def on_episodes_context_menu(self, episodes):
         """Called when the episode list context menu is opened.
 
@@ -565,7 +696,7 @@ class ExtensionManager(object):
         @param episodes: A list of gpodder.model.PodcastEpisode instances
         """  # noqa: D401
 
-    @call_extensions
+    @call_extensions_list
     def on_channel_context_menu(self, channel):
         """Called when the channel list context menu is opened.
 
@@ -640,7 +771,7 @@ class ExtensionManager(object):
         It is called after on_application_started.
         """  # noqa: D401
 
-    @call_extensions
+    @call_extensions_list
     def on_preferences(self):
         """Called when the preferences dialog is opened.
 
@@ -653,7 +784,7 @@ class ExtensionManager(object):
         [('Tab name', lambda: ...)]
         """  # noqa: D401
 
-    @call_extensions
+    @call_extensions_list
     def on_channel_settings(self, channel):
         """Called when a channel settings dialog is opened.
 